@@ -5,24 +5,28 @@ imgdiff by Marius Gedminas <marius@gedmin.as>
 Released under the MIT licence.
 """
 
+import contextlib
+import functools
 import optparse
 import os
 import shutil
-import subprocess
+import string
 import sys
 import tempfile
+import threading
 import time
 
+import numpy as np
+
 # There are two ways PIL used to be packaged
 try:
-    from PIL import Image, ImageChops, ImageDraw, ImageFilter
+    from PIL import Image, ImageChops, ImageDraw
 except ImportError:
     # This is the old way, and probably nobody uses it anymore.  (PIL's dead
     # anyway, Pillow supplanted it.)
     import Image
     import ImageChops
     import ImageDraw
-    import ImageFilter
 
 
 __version__ = '1.8.1.dev0'
@@ -44,24 +48,21 @@ def parse_color(color):
         True
 
     Raises ValueError on errors.
+
+        >>> parse_color('12g')
+        Traceback (most recent call last):
+          ...
+        ValueError: bad color '12g'
+
     """
-    if len(color) not in (3, 4, 6, 8):
+    # NB: bytes.fromhex() would also accept whitespace between the bytes
+    if len(color) not in (3, 4, 6, 8) or color.strip(string.hexdigits):
         raise ValueError('bad color %s' % repr(color))
     if len(color) in (3, 4):
-        r = int(color[0], 16) * 0x11
-        g = int(color[1], 16) * 0x11
-        b = int(color[2], 16) * 0x11
-    elif len(color) in (6, 8):
-        r = int(color[0:2], 16)
-        g = int(color[2:4], 16)
-        b = int(color[4:6], 16)
-    if len(color) == 4:
-        a = int(color[3], 16) * 0x11
-    elif len(color) == 8:
-        a = int(color[6:8], 16)
-    else:
-        a = 0xff
-    return (r, g, b, a)
+        color = ''.join(c * 2 for c in color)
+    if len(color) == 6:
+        color += 'ff'
+    return tuple(bytes.fromhex(color))
 
 
 def check_color(option, opt, value):
@@ -150,10 +151,26 @@ def main(argv=None):
     elif os.path.isdir(file1):
         file1 = os.path.join(file1, os.path.basename(file2))
 
-    img1 = Image.open(file1).convert("RGB")
-    img2 = Image.open(file2).convert("RGB")
+    for filename in (file1, file2):
+        if not os.path.exists(filename):
+            parser.error('no such file: %s' % filename)
+
+    if os.path.samefile(file1, file2):
+        img1 = img2 = load_image(file1)
+    elif opts.smart_highlight or opts.highlight:
+        # Pillow releases the GIL while it decodes images, so we can load
+        # both at the same time.  Worker threads cost an extra import, so we
+        # only bother when there's going to be slow highlighting work too.
+        with thread_pool() as map_in_threads:
+            img1, img2 = map_in_threads(load_image, [file1, file2])
+    else:
+        img1, img2 = load_image(file1), load_image(file2)
 
-    if opts.smart_highlight:
+    if img2 is img1 and (opts.smart_highlight or opts.highlight):
+        # A file compared with itself has no differences to look for; this
+        # is what both highlighters would produce, only much faster.
+        mask1 = mask2 = Image.new('L', img1.size, opts.opacity)
+    elif opts.smart_highlight:
         mask1, mask2 = slow_highlight(img1, img2, opts)
     elif opts.highlight:
         mask1, mask2 = simple_highlight(img1, img2, opts)
@@ -172,6 +189,16 @@ def main(argv=None):
         spawn_viewer(opts.viewer, img, name, grace=opts.grace)
 
 
+def load_image(filename):
+    """Load an image file and convert it to RGB."""
+    img = Image.open(filename)
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    # convert() would make a needless copy
+    img.load()
+    return img
+
+
 def pick_orientation(img1, img2, spacing, desired_aspect=1.618):
     """Pick a tiling orientation for two images.
 
@@ -222,18 +249,33 @@ def tile_images(img1, img2, mask1, mask2, opts):
         pos1 = (B, (h - h1) // 2)
         pos2 = (B + w1 + S, (h - h2) // 2)
         separator_line = [(B + w1 + S//2, 0), (B + w1 + S//2, h)]
+        same_size = h1 == h2
     else:
         w, h = (B + max(w1, w2) + B, B + h1 + S + h2 + B)
         pos1 = ((w - w1) // 2, B)
         pos2 = ((w - w2) // 2, B + h1 + S)
         separator_line = [(0, B + h1 + S//2), (w, B + h1 + S//2)]
+        same_size = w1 == w2
+
+    bgcolor, sepcolor = opts.bgcolor, opts.sepcolor
+    if (mask1 is None and mask2 is None and bgcolor[3] == sepcolor[3] == 0xff):
+        # Nothing is transparent, so we don't need an alpha channel, and
+        # RGB images are 25% smaller.
+        mode, bgcolor, sepcolor = 'RGB', bgcolor[:3], sepcolor[:3]
+    else:
+        mode = 'RGBA'
 
-    img = Image.new('RGBA', (w, h), opts.bgcolor)
+    if same_size and B == 0 and S <= 1 and mask1 is None and mask2 is None:
+        # The images and the separator line will cover every pixel, so
+        # don't waste time filling the image with the background color.
+        bgcolor = None
+
+    img = Image.new(mode, (w, h), bgcolor)
 
     img.paste(img1, pos1, mask1)
     img.paste(img2, pos2, mask2)
 
-    ImageDraw.Draw(img).line(separator_line, fill=opts.sepcolor)
+    ImageDraw.Draw(img).line(separator_line, fill=sepcolor)
 
     return img
 
@@ -252,10 +294,12 @@ def spawn_viewer(viewer, img, filename, grace):
     before removing the temporary file.  Useful if your viewer forks
     into background before it opens the file.
     """
+    import subprocess  # imported lazily, to make imgdiff start faster
     tempdir = tempfile.mkdtemp(prefix='imgdiff-')
     try:
         imgfile = os.path.join(tempdir, filename)
-        img.save(imgfile)
+        # The file is thrown away soon, so don't spend time compressing it
+        img.save(imgfile, 'PNG', compress_level=1)
         started = time.time()
         subprocess.call([viewer, imgfile])
         elapsed = time.time() - started
@@ -276,10 +320,70 @@ def tweak_diff(diff, opacity):
     The result is that similar areas will have a given opacity, while
     dissimilar areas will be opaque.
     """
-    mask = diff.point(lambda i: opacity + i * (255 - opacity) // 255)
+    table = [opacity + i * (255 - opacity) // 255 for i in range(256)]
+    mask = diff.point(table)
     return mask
 
 
+def max_filter(a, size):
+    """Apply a ``size`` x ``size`` maximum filter to a 2D array.
+
+    Like PIL's ``ImageFilter.MaxFilter``, but faster.  Only the part of the
+    window that lies inside the array is considered near the edges.  The
+    array must not contain negative values.
+
+        >>> a = np.zeros((3, 5), dtype=np.uint8)
+        >>> a[0, 1] = 7
+        >>> max_filter(a, 3).tolist()
+        [[7, 7, 7, 0, 0], [7, 7, 7, 0, 0], [0, 0, 0, 0, 0]]
+
+    """
+    # A square maximum filter is separable: filter the rows, then filter
+    # the columns.  We pad each row with zeros, which cannot affect the
+    # maximum, and then compute the maximum of every 1, 2, 4, ... adjacent
+    # pixels, which needs about log2(size) passes instead of size - 1.
+    r = size // 2
+    for axis in (0, 1):
+        src = np.swapaxes(a, 0, axis)
+        n = src.shape[0]
+        buf = np.zeros((n + 2 * r,) + src.shape[1:], dtype=src.dtype)
+        buf[r:r+n] = src
+        m = len(buf)
+        width = 1
+        while 2 * width < size:
+            np.maximum(buf[:m-width], buf[width:], out=buf[:m-width])
+            width *= 2
+        if width < size:
+            # Two overlapping windows of this width cover the whole size.
+            np.maximum(buf[:n], buf[size-width:size-width+n], out=buf[:n])
+        a = np.swapaxes(buf[:n], 0, axis)
+    return np.ascontiguousarray(a)
+
+
+def padded_array(img, size, pos, bgcolor):
+    """Convert an RGB image into a NumPy array padded with a background color.
+
+    ``size`` is the size (width, height) of the padded array.
+
+    ``pos`` is the position (x, y) of the image inside the padded array.
+
+    The array has the shape (3, height, width), i.e. each color channel is
+    stored separately.  This is friendlier to the CPU cache than the usual
+    interleaved RGB layout when we want to compare channels separately.
+    """
+    (w, h), (x, y) = size, pos
+    x2, y2 = x + img.size[0], y + img.size[1]
+    a = np.empty((3, h, w), dtype=np.uint8)
+    for plane, band, color in zip(a, img.split(), bgcolor):
+        plane[y:y2, x:x2] = np.asarray(band)
+        # Fill only the padding around the image, not the whole plane.
+        plane[:y] = color
+        plane[y2:] = color
+        plane[y:y2, :x] = color
+        plane[y:y2, x2:] = color
+    return a
+
+
 def diff(img1, img2, x1y1, x2y2):
     """Compare two images with given alignments.
 
@@ -352,20 +456,35 @@ def diff(img1, img2, x1y1, x2y2):
     return diff
 
 
-def diff_badness(diff):
-    """Estimate the "badness" value of a difference map.
+def window_sums(a, w, h):
+    """Compute the sums of all ``w`` x ``h`` windows of a 2D array.
 
-    Returns 0 if the pictures are identical
+    Returns an array ``s`` where ``s[y, x] == a[y:y+h, x:x+w].sum()``.
 
-    Returns a large number if the pictures are completely different
-    (e.g. a black field and a white field).  More specifically, returns
-    ``255 * width * height`` where ``(width, height) == diff.size``.
+        >>> a = np.arange(12).reshape(3, 4)
+        >>> window_sums(a, 2, 2).tolist()
+        [[10, 14, 18], [26, 30, 34]]
+        >>> window_sums(a, 4, 2).tolist()
+        [[28], [60]]
+        >>> window_sums(a, 2, 3).tolist()
+        [[27, 33, 39]]
 
-    Returns something in between for other situations.
     """
-    # identical pictures = black image = return 0
-    # completely different pictures = white image = return lots
-    return sum(i * n for i, n in enumerate(diff.histogram()))
+    # We add up the columns of the windows first, and then the rows of those
+    # column sums, using running totals.  best_alignment() often wants
+    # windows as tall (or as wide) as the whole array, and then a plain sum
+    # is much cheaper than a running total.
+    if h == a.shape[0]:
+        cols = a.sum(axis=0, dtype=np.int64, keepdims=True)
+    else:
+        cols = np.zeros((a.shape[0] + 1, a.shape[1]), dtype=np.int64)
+        a.cumsum(axis=0, dtype=np.int64, out=cols[1:])
+        cols = cols[h:] - cols[:-h]
+    if w == a.shape[1]:
+        return cols.sum(axis=1, keepdims=True)
+    rows = np.zeros((cols.shape[0], cols.shape[1] + 1), dtype=np.int64)
+    cols.cumsum(axis=1, out=rows[:, 1:])
+    return rows[:, w:] - rows[:, :-w]
 
 
 class Timeout(KeyboardInterrupt):
@@ -380,6 +499,7 @@ class Progress(object):
         self.total = total
         self.what = what
         self.position = 0
+        self.percent = None
         self.shown = False
         self.timeout = timeout
         self.stream = sys.stderr
@@ -400,15 +520,23 @@ class Progress(object):
         self.shown = True
 
     def next(self):
-        self.position += 1
-        if self.timeout and time.time() - self.started > self.timeout:
+        self.advance(1)
+
+    def advance(self, n):
+        self.position += n
+        elapsed = time.time() - self.started
+        if self.timeout and elapsed > self.timeout:
             self._say('Highlighting takes too long: timed out after %.0f seconds'
                       % self.timeout)
             raise Timeout
-        if time.time() - self.started >= self.delay:
+        percent = self.position * 100 // self.total
+        if elapsed >= self.delay and percent != self.percent:
+            # Writing to the terminal is not free, so we do it only when
+            # there's a visible change.
             self._say_if_terminal('%d%% (%d out of %d %s)'
-                                  % (self.position * 100 // self.total,
-                                     self.position, self.total, self.what))
+                                  % (percent, self.position, self.total,
+                                     self.what))
+            self.percent = percent
         if self.position == self.total:
             self.done()
 
@@ -418,6 +546,57 @@ class Progress(object):
             self.shown = False
 
 
+def thread_count():
+    """Return the number of worker threads to use for NumPy number crunching.
+
+    NumPy releases the GIL while it crunches large arrays, so worker threads
+    let us use more than one CPU core.
+    """
+    # The work is bound by memory bandwidth, so more threads wouldn't help
+    # much, but every thread may need its own scratch buffers.
+    return min(os.cpu_count() or 1, 4)
+
+
+@contextlib.contextmanager
+def thread_pool():
+    """Provide a ``map()`` that spreads the work over worker threads.
+
+    Falls back to the builtin ``map()`` if we have only one CPU core.
+    """
+    workers = thread_count()
+    if workers <= 1:
+        yield map
+    else:
+        import concurrent.futures  # imported lazily, see spawn_viewer()
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            yield pool.map
+
+
+def run_parallel(func, tasks, progress):
+    """Call ``func(*task)`` for every task in a pool of worker threads.
+
+    Calls ``progress.next()`` after every finished task.  If that raises an
+    exception (e.g. Timeout), the tasks that haven't started yet are
+    cancelled.
+    """
+    workers = min(thread_count(), len(tasks))
+    if workers <= 1:
+        for task in tasks:
+            func(*task)
+            progress.next()
+        return
+    import concurrent.futures  # imported lazily, see spawn_viewer()
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(func, *task) for task in tasks]
+        try:
+            for future in futures:
+                future.result()
+                progress.next()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
 def best_diff(img1, img2, opts):
     """Find the best alignment of two images that minimizes the differences.
 
@@ -426,34 +605,161 @@ def best_diff(img1, img2, opts):
 
     See ``diff()`` for the description of the alignment numbers.
     """
+    if img1.size == img2.size:
+        # There's only one possible alignment, and no cropping is needed.
+        return ImageChops.difference(img1, img2).convert('L'), ((0, 0), (0, 0))
+
     w1, h1 = img1.size
     w2, h2 = img2.size
+    xr = abs(w1 - w2) + 1
+    yr = abs(h1 - h2) + 1
+
+    # Comparing NumPy array slices is much cheaper than cropping and diffing
+    # PIL images for every possible alignment.  We only build the
+    # difference map for the winner.
+    a1 = color_planes(img1)
+    a2 = color_planes(img2)
+
+    p = Progress(xr * yr, timeout=opts.timeout)
+    best_pos = best_alignment(a1, a2, p.advance)
+    return diff(img1, img2, *best_pos), best_pos
+
+
+def color_planes(img):
+    """Convert an RGB image into a (3, height, width) int16 NumPy array."""
+    return np.stack([np.asarray(band, dtype=np.int16) for band in img.split()])
+
+
+def downscale(a, factor=4):
+    """Shrink a 2D array by summing up ``factor`` x ``factor`` blocks.
+
+    Leftover rows and columns at the bottom and right edges are dropped.
+    Arrays with more dimensions are shrunk along the last two.
+
+        >>> downscale(np.arange(20).reshape(4, 5), 2).tolist()
+        [[12, 20], [52, 60]]
+        >>> downscale(downscale(np.full((16, 16), 255, np.int16))).tolist()
+        [[65280]]
+
+    """
+    h, w = a.shape[-2] // factor, a.shape[-1] // factor
+    blocks = a[..., :h * factor, :w * factor]
+    blocks = blocks.reshape(a.shape[:-2] + (h, factor, w, factor))
+    # NB: int32 is big enough for several levels of 4x4 sums of bytes
+    return blocks.sum(axis=(-3, -1), dtype=np.int32)
+
+
+# The weights PIL uses for converting RGB to grayscale, times 1000
+_LUMA_WEIGHTS = np.array([299, 587, 114], dtype=np.int64)
+
+
+def best_alignment(a1, a2, advance=None):
+    """Find the best alignment of two RGB images.
+
+    ``a1`` and ``a2`` are (3, height, width) arrays of a signed integer
+    type, as returned by ``color_planes()``.  Alignments are scored by
+    approximately the grayscale value of their difference, as ``diff()``
+    computes it: the weighted channel differences aren't rounded to whole
+    pixel values, so near-ties can come out the other way.
+
+    This is the search part of ``best_diff()``; it returns the alignments
+    in the same format.
+
+    Calls ``advance(n)`` after looking at ``n`` more alignments, if
+    ``advance`` is not None.  It also calls ``advance(0)`` before every
+    bit of work that doesn't count as an alignment, so ``advance`` can
+    interrupt the search by raising an exception.
+    """
+    if advance is None:
+        def advance(n):
+            pass
+
+    h1, w1 = a1.shape[1:]
+    h2, w2 = a2.shape[1:]
     w, h = min(w1, w2), min(h1, h2)
-    best = None
-    best_value = 255 * w * h + 1
 
     xr = abs(w1 - w2) + 1
     yr = abs(h1 - h2) + 1
 
-    p = Progress(xr * yr, timeout=opts.timeout)
-    for x in range(xr):
-        if w1 > w2:
-            x1, x2 = x, 0
-        else:
-            x1, x2 = 0, x
-        for y in range(yr):
-            if h1 > h2:
-                y1, y2 = y, 0
-            else:
-                y1, y2 = 0, y
-            p.next()
-            this = diff(img1, img2, (x1, y1), (x2, y2))
-            this_value = diff_badness(this)
-            if this_value < best_value:
-                best = this
-                best_value = this_value
-                best_pos = (x1, y1), (x2, y2)
-    return best, best_pos
+    def pos(x, y):
+        x1, x2 = (x, 0) if w1 > w2 else (0, x)
+        y1, y2 = (y, 0) if h1 > h2 else (0, y)
+        return (x1, y1), (x2, y2)
+
+    # We sum up the differences in horizontal strips of about 64K pixels and
+    # give up as soon as the partial sum shows that this alignment cannot
+    # beat ``best``.  The partial sum is good enough for min() then.
+    strip = max(1, 65536 // w)
+    # Summing into int32 is much faster than into int64.  A strip of a
+    # channel of bytes adds up to at most 255 * 65536, which fits, but the
+    # int32 arrays of downscaled images can hold much bigger values.
+    sum_dtype = np.int32 if a1.dtype == np.int16 else np.int64
+
+    def badness(x, y, best=None):
+        (x1, y1), (x2, y2) = pos(x, y)
+        total = 0
+        for top in range(0, h, strip):
+            bottom = min(top + strip, h)
+            s1 = a1[:, y1+top:y1+bottom, x1:x1+w]
+            s2 = a2[:, y2+top:y2+bottom, x2:x2+w]
+            this = np.abs(s1 - s2).sum(axis=(1, 2), dtype=sum_dtype)
+            total += int(_LUMA_WEIGHTS @ this)
+            if best is not None and (total, x, y) >= best:
+                break
+        return total
+
+    # We keep track of (badness, x, y) for the best alignment, so that ties
+    # are always resolved in favour of the first one in scan order, no
+    # matter in which order we actually look at the alignments.
+    best = (float('inf'), 0, 0)
+
+    if xr * yr > 64 and w >= 32 and h >= 32:
+        # Do a quick search at a quarter of the resolution and look closely
+        # at the neighbourhood of the alignment it finds.  This gives us a
+        # good starting point, which lets us skip many more of the
+        # alignments below.
+        (x1, y1), (x2, y2) = best_alignment(downscale(a1), downscale(a2),
+                                            lambda n: advance(0))
+        cx, cy = (x1 + x2) * 4, (y1 + y2) * 4
+        for x in range(max(0, cx - 4), min(xr, cx + 5)):
+            for y in range(max(0, cy - 4), min(yr, cy + 5)):
+                advance(0)
+                best = min(best, (badness(x, y, best), x, y))
+
+    # sum(|a - b|) >= |sum(a) - sum(b)| for every channel, so we can cheaply
+    # skip alignments that cannot beat the best one found so far.  For each
+    # axis only one of the images has more than one window position, so the
+    # broadcast gives us a (yr, xr) array of lower bounds.
+    lower_bound = sum(
+        weight * np.abs(window_sums(c1, w, h) - window_sums(c2, w, h))
+        for weight, c1, c2 in zip(_LUMA_WEIGHTS, a1, a2))
+
+    # We score the alignments in batches, one alignment per worker thread,
+    # so that the best one found so far can still be used to skip the rest.
+    # Skipped alignments are counted in bulk, together with the next batch.
+    batch_size = thread_count()
+    batch = []
+    skipped = 0
+
+    def scored(batch, map_in_threads):
+        scores = map_in_threads(lambda xy: badness(*xy, best=best), batch)
+        return [(n, x, y) for n, (x, y) in zip(scores, batch)]
+
+    with thread_pool() as map_in_threads:
+        for x in range(xr):
+            for y in range(yr):
+                if (lower_bound[y, x], x, y) >= best:
+                    skipped += 1
+                    continue
+                batch.append((x, y))
+                if len(batch) == batch_size:
+                    best = min([best] + scored(batch, map_in_threads))
+                    advance(skipped + len(batch))
+                    batch = []
+                    skipped = 0
+        best = min([best] + scored(batch, map_in_threads))
+        advance(skipped + len(batch))
+    return pos(best[1], best[2])
 
 
 def simple_highlight(img1, img2, opts):
@@ -471,17 +777,62 @@ def simple_highlight(img1, img2, opts):
         diff, ((x1, y1), (x2, y2)) = best_diff(img1, img2, opts)
     except KeyboardInterrupt:
         return None, None
-    diff = diff.filter(ImageFilter.MaxFilter(9))
+    diff = Image.fromarray(max_filter(np.asarray(diff), 9))
     diff = tweak_diff(diff, opts.opacity)
     # If the images have different sizes, the areas outside the alignment
     # zone are considered to be dissimilar -- filling them with 0xff.
     # Perhaps it would be better to compare those bits with bars of solid
     # color, filled with opts.bgcolor?
-    mask1 = Image.new('L', img1.size, 0xff)
-    mask2 = Image.new('L', img2.size, 0xff)
-    mask1.paste(diff, (x1, y1))
-    mask2.paste(diff, (x2, y2))
-    return mask1, mask2
+    masks = []
+    for img, pos in [(img1, (x1, y1)), (img2, (x2, y2))]:
+        if img.size == diff.size:
+            # Nothing to fill, and the masks are never modified, so they
+            # can share the image.
+            mask = diff
+        else:
+            mask = Image.new('L', img.size, 0xff)
+            mask.paste(diff, pos)
+        masks.append(mask)
+    return tuple(masks)
+
+
+def channel_diff(a1, a2, tmp_rgb1, tmp_rgb2, out):
+    """Compute the largest per-channel difference of two aligned images.
+
+    ``a1`` and ``a2`` are (3, H, W) uint8 arrays, as returned by
+    ``padded_array()``.
+
+    ``tmp_rgb1`` and ``tmp_rgb2`` are scratch arrays with the same shapes
+    and types as ``a1`` and ``a2``.  The result is stored in ``out``, a
+    (H, W) uint8 array, which is also returned.
+    """
+    # |a1 - a2| == max(a1, a2) - min(a1, a2), and this way we never leave
+    # uint8, which means less memory traffic than with int16 arrays.
+    np.maximum(a1, a2, out=tmp_rgb1)
+    np.minimum(a1, a2, out=tmp_rgb2)
+    np.subtract(tmp_rgb1, tmp_rgb2, out=tmp_rgb1)
+    # NB: this is a lot faster than tmp_rgb1.max(axis=0, out=out)
+    np.maximum(tmp_rgb1[0], tmp_rgb1[1], out=out)
+    np.maximum(out, tmp_rgb1[2], out=out)
+    return out
+
+
+def update_diff(diff, a1, a2, tmp_rgb1, tmp_rgb2, tmp):
+    """Merge the difference of two aligned images into a difference map.
+
+    ``a1`` and ``a2`` are (3, H, W) uint8 arrays, as returned by
+    ``padded_array()``.
+
+    ``diff`` is a (H, W) uint8 array.  It gets updated in place to be the
+    point-wise minimum of itself and the smoothed difference map of ``a1``
+    and ``a2``.
+
+    ``tmp_rgb1``, ``tmp_rgb2`` and ``tmp`` are scratch arrays with the same
+    shapes and types as ``a1``, ``a2`` and ``diff``, so we don't have to
+    allocate new ones for every alignment.
+    """
+    channel_diff(a1, a2, tmp_rgb1, tmp_rgb2, tmp)
+    np.minimum(diff, max_filter(tmp, 7), out=diff)
 
 
 def slow_highlight(img1, img2, opts):
@@ -506,48 +857,67 @@ def slow_highlight(img1, img2, opts):
     outer boundaries of the images, in case some pixels got shifted closer
     to an edge.
     """
+    if img1.size == img2.size:
+        # There's only one alignment, so there's nothing to pad and no
+        # minimum to take, and the 7x7 and 5x5 max filters below add up to
+        # a single 11x11 one.
+        a1 = padded_array(img1, img1.size, (0, 0), opts.bgcolor)
+        a2 = padded_array(img2, img2.size, (0, 0), opts.bgcolor)
+        diff = channel_diff(a1, a2, np.empty_like(a1), np.empty_like(a2),
+                            np.empty(a1.shape[1:], dtype=np.uint8))
+        mask = tweak_diff(Image.fromarray(max_filter(diff, 11)), opts.opacity)
+        return mask, mask
+
     w1, h1 = img1.size
     w2, h2 = img2.size
     W, H = max(w1, w2), max(h1, h2)
 
-    pimg1 = Image.new('RGB', (W, H), opts.bgcolor)
-    pimg2 = Image.new('RGB', (W, H), opts.bgcolor)
+    xr = abs(w1 - w2) + 1
+    yr = abs(h1 - h2) + 1
 
-    pimg1.paste(img1, (0, 0))
-    pimg2.paste(img2, (0, 0))
+    # Instead of shifting the smaller image around, we pad each image with
+    # the background color on the side it's going to be shifted from, and
+    # then look at the padded arrays through W x H windows.  This is
+    # equivalent to cyclically shifting a W x H image, since only
+    # background pixels would wrap around.
+    mx1, mx2 = (0, xr - 1) if w1 > w2 else (xr - 1, 0)
+    my1, my2 = (0, yr - 1) if h1 > h2 else (yr - 1, 0)
+    pimg1 = padded_array(img1, (W + mx1, H + my1), (mx1, my1), opts.bgcolor)
+    pimg2 = padded_array(img2, (W + mx2, H + my2), (mx2, my2), opts.bgcolor)
 
-    diff = Image.new('L', (W, H), 255)
     # It is not a good idea to keep one diff image; it should track the
     # relative positions of the two images.  I think that's what explains
     # the fuzz I see near the edges of the different areas.
-
-    xr = abs(w1 - w2) + 1
-    yr = abs(h1 - h2) + 1
+    diffs = []
+    local = threading.local()
+
+    def compare(x, y):
+        # Every worker thread gets its own difference map and scratch
+        # buffers; we merge the difference maps at the end.
+        try:
+            buffers = local.buffers
+        except AttributeError:
+            buffers = local.buffers = (
+                np.full((H, W), 255, dtype=np.uint8),
+                np.empty((3, H, W), dtype=np.uint8),
+                np.empty((3, H, W), dtype=np.uint8),
+                np.empty((H, W), dtype=np.uint8),
+            )
+            diffs.append(buffers[0])
+        x1, x2 = (mx1, mx2 - x) if w1 > w2 else (mx1 - x, mx2)
+        y1, y2 = (my1, my2 - y) if h1 > h2 else (my1 - y, my2)
+        update_diff(buffers[0], pimg1[:, y1:y1+H, x1:x1+W],
+                    pimg2[:, y2:y2+H, x2:x2+W], *buffers[1:])
 
     try:
         p = Progress(xr * yr, timeout=opts.timeout)
-        for x in range(xr):
-            for y in range(yr):
-                p.next()
-                this = ImageChops.difference(pimg1, pimg2).convert('L')
-                this = this.filter(ImageFilter.MaxFilter(7))
-                diff = ImageChops.darker(diff, this)
-                if h1 > h2:
-                    pimg2 = ImageChops.offset(pimg2, 0, 1)
-                else:
-                    pimg1 = ImageChops.offset(pimg1, 0, 1)
-            if h1 > h2:
-                pimg2 = ImageChops.offset(pimg2, 0, -yr)
-            else:
-                pimg1 = ImageChops.offset(pimg1, 0, -yr)
-            if w1 > w2:
-                pimg2 = ImageChops.offset(pimg2, 1, 0)
-            else:
-                pimg1 = ImageChops.offset(pimg1, 1, 0)
+        run_parallel(compare, [(x, y) for x in range(xr) for y in range(yr)],
+                     p)
     except KeyboardInterrupt:
         return None, None
 
-    diff = diff.filter(ImageFilter.MaxFilter(5))
+    diff = functools.reduce(lambda a, b: np.minimum(a, b, out=a), diffs)
+    diff = Image.fromarray(max_filter(diff, 5))
 
     diff1 = diff.crop((0, 0, w1, h1))
     diff2 = diff.crop((0, 0, w2, h2))
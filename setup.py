@@ -4,26 +4,28 @@ import re
 
 from setuptools import setup
 
+here = os.path.dirname(os.path.abspath(__file__))
+
 
 def relative(filename):
-    here = os.path.dirname('__file__')
     return os.path.join(here, filename)
 
 
 def read(filename):
-    f = open(relative(filename))
-    try:
+    with open(relative(filename), encoding='utf-8') as f:
         return f.read()
-    finally:
-        f.close()
+
+
+VERSION_RE = re.compile(r'''^__version__ = (["'])(.+)\1$''')
 
 
 def get_version():
-    r = re.compile(r'''^__version__ = (["'])(.+)\1$''')
-    for line in read('imgdiff.py').splitlines():
-        m = r.match(line)
-        if m:
-            return m.group(2)
+    # __version__ is near the top, so don't read the rest of the file
+    with open(relative('imgdiff.py'), encoding='utf-8') as f:
+        for line in f:
+            m = VERSION_RE.match(line)
+            if m:
+                return m.group(2)
 
 
 def get_description():
@@ -63,7 +65,7 @@ setup(name='imgdiff',
       python_requires=">=3.7",
       py_modules=['imgdiff'],
       zip_safe=False,
-      install_requires=['Pillow'],
+      install_requires=['Pillow', 'numpy'],
       extras_require={
           'test': [
               'mock',
@@ -1,62 +1,75 @@
 import doctest
+import itertools
 import os
 import shutil
-import sys
 import tempfile
 import unittest
+from io import StringIO
 
 import mock
+import numpy as np
+from PIL import ImageFilter
 
 import imgdiff
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from io import StringIO
 
-
-@mock.patch('sys.stderr', StringIO())
 class TestMain(unittest.TestCase):
 
-    def setUp(self):
-        self.tmpdir = None
-
-    def tearDown(self):
-        if self.tmpdir:
-            shutil.rmtree(self.tmpdir)
+    # One temporary directory for all the tests; they use different filenames
+    @classmethod
+    def setUpClass(cls):
+        cls._tmpdir = tempfile.TemporaryDirectory(prefix='imgdiff-tests-')
+        cls.tmpdir = cls._tmpdir.name
 
-    def mkdtemp(self):
-        if self.tmpdir is None:
-            self.tmpdir = tempfile.mkdtemp(prefix='imgdiff-tests-')
-        return self.tmpdir
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmpdir.cleanup()
 
     def main(self, *args):
-        try:
-            imgdiff.main(['imgdiff'] + list(args))
-        except SystemExit:
-            pass
+        imgdiff.main(['imgdiff'] + list(args))
+
+    def main_error(self, *args):
+        with self.assertRaises(SystemExit):
+            self.main(*args)
 
     def assertIn(self, member, container):  # Python 2.6 compat
         if member not in container:
             self.fail('%s not found in %s' % (repr(member), repr(container)))
 
-    def test_color_parsing_in_options(self):
-        self.main('--bgcolor', 'invalid')
+    @mock.patch('sys.stderr', new_callable=StringIO)
+    def test_color_parsing_in_options(self, stderr):
+        self.main_error('--bgcolor', 'invalid')
         self.assertIn("error: option --bgcolor: invalid color value: 'invalid'",
-                      sys.stderr.getvalue())
+                      stderr.getvalue())
 
-    def test_wrong_number_of_arguments(self):
-        self.main('foo.png')
+    @mock.patch('sys.stderr', new_callable=StringIO)
+    def test_wrong_number_of_arguments(self, stderr):
+        self.main_error('foo.png')
         self.assertIn("error: expecting two arguments, got 1",
-                      sys.stderr.getvalue())
-        self.main('foo.png', 'bar.png', 'baz.png')
+                      stderr.getvalue())
+        stderr.seek(0)
+        stderr.truncate()
+        self.main_error('foo.png', 'bar.png', 'baz.png')
         self.assertIn("error: expecting two arguments, got 3",
-                      sys.stderr.getvalue())
+                      stderr.getvalue())
+
+    @mock.patch('sys.stderr', new_callable=StringIO)
+    def test_missing_file(self, stderr):
+        self.main_error('example1.png', 'nosuchfile.png')
+        self.assertIn("error: no such file: nosuchfile.png",
+                      stderr.getvalue())
+
+    def test_loading_in_threads(self):
+        fn = os.path.join(self.tmpdir, 'threads.png')
+        with mock.patch('os.cpu_count', return_value=2):
+            self.main('example1.png', 'example2.png', '-H', '-o', fn)
+        self.assertTrue(os.path.exists(fn))
 
-    def test_two_directories(self):
-        self.main('set1', 'set2')
+    @mock.patch('sys.stderr', new_callable=StringIO)
+    def test_two_directories(self, stderr):
+        self.main_error('set1', 'set2')
         self.assertIn("error: at least one argument must be a file, not a directory",
-                      sys.stderr.getvalue())
+                      stderr.getvalue())
 
     def test_all_ok(self):
         self.main('example1.png', 'example2.png', '--viewer=true')
@@ -68,7 +81,7 @@ class TestMain(unittest.TestCase):
         self.main('example1.png', 'example2.png', '-S', '--viewer=true')
 
     def test_outfile(self):
-        fn = os.path.join(self.mkdtemp(), 'diff.png')
+        fn = os.path.join(self.tmpdir, 'diff.png')
         self.main('example1.png', 'example2.png', '-o', fn)
         self.assertTrue(os.path.exists(fn))
 
@@ -81,6 +94,17 @@ class TestMain(unittest.TestCase):
         self.main('set1/canary.png', 'set2', '--viewer', 'true')
         self.main('set1', 'set2/canary.png', '--viewer', 'true', '--tb')
 
+    def test_same_file(self):
+        copy = os.path.join(self.tmpdir, 'copy.png')
+        shutil.copy('example1.png', copy)
+        for option in ['-H', '-S']:
+            fn1 = os.path.join(self.tmpdir, 'same.png')
+            fn2 = os.path.join(self.tmpdir, 'copy-diff.png')
+            self.main('example1.png', 'example1.png', option, '-o', fn1)
+            self.main('example1.png', copy, option, '-o', fn2)
+            with imgdiff.Image.open(fn1) as img1, imgdiff.Image.open(fn2) as img2:
+                self.assertEqual(img1.tobytes(), img2.tobytes())
+
     def test_different_size_images(self):
         # tickle the unexplored branches in best_diff()
         self.main(
@@ -88,7 +112,7 @@ class TestMain(unittest.TestCase):
             'set1/sample-graph.png',
             '--viewer=true',
             '-H',
-            '--timeout=1',
+            '--timeout=10',
         )
 
     def test_different_size_images_sloow(self):
@@ -117,6 +141,29 @@ class TestProgress(unittest.TestCase):
                          '\r100% (3 out of 3 possible alignments)'
                          '\r\n')
 
+    def test_skips_repeated_percentages(self):
+        p = imgdiff.Progress(300, delay=0)
+        p.stream = StringIO()
+        p.isatty = True
+        for n in range(6):
+            p.next()
+        self.assertEqual(p.stream.getvalue(),
+                         '\r0% (1 out of 300 possible alignments)'
+                         '\r1% (3 out of 300 possible alignments)'
+                         '\r2% (6 out of 300 possible alignments)')
+
+    def test_advance(self):
+        p = imgdiff.Progress(6, delay=0)
+        p.stream = StringIO()
+        p.isatty = True
+        for n in range(3):
+            p.advance(2)
+        self.assertEqual(p.stream.getvalue(),
+                         '\r33% (2 out of 6 possible alignments)'
+                         '\r66% (4 out of 6 possible alignments)'
+                         '\r100% (6 out of 6 possible alignments)'
+                         '\r\n')
+
     def test_not_a_terminal(self):
         p = imgdiff.Progress(3, delay=0)
         p.stream = StringIO()
@@ -137,6 +184,168 @@ class TestProgress(unittest.TestCase):
                          'Highlighting takes too long: timed out after 1 seconds\n')
 
 
+class TestTileImages(unittest.TestCase):
+
+    def setUp(self):
+        self.img1 = imgdiff.Image.new('RGB', (2, 3), 'red')
+        self.img2 = imgdiff.Image.new('RGB', (2, 2), 'blue')
+        self.opts = mock.Mock(orientation='lr', spacing=3, border=1,
+                              bgcolor=(255, 255, 255, 255),
+                              sepcolor=(204, 204, 204, 255))
+
+    def test_no_masks(self):
+        img = imgdiff.tile_images(self.img1, self.img2, None, None, self.opts)
+        self.assertEqual(img.mode, 'RGB')
+        self.assertEqual(img.size, (9, 5))
+        self.assertEqual(img.getpixel((0, 0)), (255, 255, 255))
+        self.assertEqual(img.getpixel((4, 0)), (204, 204, 204))
+        self.assertEqual(img.getpixel((1, 1)), (255, 0, 0))
+        self.assertEqual(img.getpixel((6, 1)), (0, 0, 255))
+
+    def test_no_background_visible(self):
+        self.opts.border = 0
+        self.opts.spacing = 1
+        self.img2 = imgdiff.Image.new('RGB', (3, 3), 'blue')
+        img = imgdiff.tile_images(self.img1, self.img2, None, None, self.opts)
+        self.assertEqual(sorted(img.getcolors()),
+                         [(3, (204, 204, 204)), (6, (255, 0, 0)),
+                          (9, (0, 0, 255))])
+
+    def test_transparent_background(self):
+        self.opts.bgcolor = (255, 255, 255, 0)
+        img = imgdiff.tile_images(self.img1, self.img2, None, None, self.opts)
+        self.assertEqual(img.mode, 'RGBA')
+        self.assertEqual(img.getpixel((0, 0)), (255, 255, 255, 0))
+        self.assertEqual(img.getpixel((4, 0)), (204, 204, 204, 255))
+
+    def test_masks(self):
+        mask1 = imgdiff.Image.new('L', self.img1.size, 0)
+        img = imgdiff.tile_images(self.img1, self.img2, mask1, None, self.opts)
+        self.assertEqual(img.mode, 'RGBA')
+        self.assertEqual(img.getpixel((1, 1)), (255, 255, 255, 255))
+        self.assertEqual(img.getpixel((6, 1)), (0, 0, 255, 255))
+
+
+class TestMaxFilter(unittest.TestCase):
+
+    def test_same_as_pil(self):
+        img = imgdiff.Image.open('set1/sample-graph.png').convert('L')
+        for size in (3, 5, 7, 9):
+            expected = img.filter(ImageFilter.MaxFilter(size))
+            result = imgdiff.max_filter(np.asarray(img), size)
+            self.assertEqual(result.tolist(),
+                             np.asarray(expected).tolist())
+
+    def test_composition(self):
+        # slow_highlight() relies on this for same-size images
+        img = imgdiff.Image.open('set1/sample-graph.png').convert('L')
+        a = np.asarray(img)
+        self.assertEqual(imgdiff.max_filter(imgdiff.max_filter(a, 7), 5).tolist(),
+                         imgdiff.max_filter(a, 11).tolist())
+
+
+class TestBestDiff(unittest.TestCase):
+
+    def test_best_alignment(self):
+        img1 = imgdiff.Image.new('RGB', (4, 2), 'white')
+        img1.paste('black', (1, 0, 3, 2))
+        img2 = imgdiff.Image.new('RGB', (2, 2), 'black')
+        opts = mock.Mock(timeout=None)
+        diff, pos = imgdiff.best_diff(img1, img2, opts)
+        self.assertEqual(pos, ((1, 0), (0, 0)))
+        self.assertEqual(diff.size, (2, 2))
+        self.assertIsNone(diff.getbbox())
+
+    def test_colors_of_the_same_brightness(self):
+        # red and this green are both 76 in grayscale, but they're not
+        # the same color
+        img1 = imgdiff.Image.new('RGB', (3, 1), 'red')
+        img1.putpixel((0, 0), (0, 130, 0))
+        img2 = imgdiff.Image.new('RGB', (2, 1), 'red')
+        opts = mock.Mock(timeout=None)
+        diff, pos = imgdiff.best_diff(img1, img2, opts)
+        self.assertEqual(pos, ((1, 0), (0, 0)))
+
+    def noise(self, size, seed):
+        a = np.random.RandomState(seed).randint(0, 256, size + (3,))
+        return imgdiff.Image.fromarray(a.astype(np.uint8))
+
+    def test_counts_every_alignment(self):
+        a1 = imgdiff.color_planes(self.noise((300, 40), 1))
+        a2 = imgdiff.color_planes(self.noise((100, 40), 2))
+        advance = mock.Mock()
+        imgdiff.best_alignment(a1, a2, advance)
+        counts = [args[0] for args, kw in advance.call_args_list]
+        self.assertEqual(sum(counts), 201)
+        self.assertGreater(len([n for n in counts if n]), 1)
+
+    @mock.patch('sys.stderr', new_callable=StringIO)
+    def test_timeout_with_one_column(self, stderr):
+        # The images have the same width, so there's just one column of
+        # alignments, and every reading of the clock is a second later.
+        img1 = self.noise((300, 40), 1)
+        img2 = self.noise((100, 40), 2)
+        opts = mock.Mock(timeout=5)
+        with mock.patch('time.time', side_effect=itertools.count()):
+            self.assertRaises(imgdiff.Timeout,
+                              imgdiff.best_diff, img1, img2, opts)
+
+    def test_threads_give_same_result(self):
+        img1 = imgdiff.Image.open('set1/extra-info.png').convert('RGB')
+        img2 = imgdiff.Image.open('set1/sample-graph.png').convert('RGB')
+        a1 = imgdiff.color_planes(img1.crop((0, 0, 80, 90)))
+        a2 = imgdiff.color_planes(img2.crop((0, 0, 60, 60)))
+        results = []
+        for cpu_count in (1, 4):
+            with mock.patch('os.cpu_count', return_value=cpu_count):
+                results.append(imgdiff.best_alignment(a1, a2))
+        self.assertEqual(results[0], results[1])
+
+
+class TestRunParallel(unittest.TestCase):
+
+    def run_parallel(self, cpu_count, func, tasks, progress):
+        with mock.patch('os.cpu_count', return_value=cpu_count):
+            imgdiff.run_parallel(func, tasks, progress)
+
+    def check(self, cpu_count):
+        results = []
+        progress = mock.Mock()
+        self.run_parallel(cpu_count, lambda a, b: results.append(a * b),
+                          [(1, 2), (3, 4), (5, 6)], progress)
+        self.assertEqual(sorted(results), [2, 12, 30])
+        self.assertEqual(progress.next.call_count, 3)
+
+    def test_sequential(self):
+        self.check(1)
+
+    def test_parallel(self):
+        self.check(4)
+
+    def test_timeout(self):
+        progress = mock.Mock()
+        progress.next.side_effect = imgdiff.Timeout
+        self.assertRaises(imgdiff.Timeout, self.run_parallel,
+                          4, lambda: None, [(), (), ()], progress)
+
+
+class TestSlowHighlight(unittest.TestCase):
+
+    def test_threads_give_same_result(self):
+        img1 = imgdiff.Image.open('set1/extra-info.png').convert('RGB')
+        img2 = imgdiff.Image.open('set1/sample-graph.png').convert('RGB')
+        img1 = img1.crop((0, 0, 60, 50))
+        img2 = img2.crop((0, 0, 50, 45))
+        opts = mock.Mock(timeout=None, opacity=64,
+                         bgcolor=(255, 255, 255, 255))
+        results = []
+        for cpu_count in (1, 4):
+            with mock.patch('os.cpu_count', return_value=cpu_count):
+                mask1, mask2 = imgdiff.slow_highlight(img1, img2, opts)
+            results.append((mask1.tobytes(), mask2.tobytes()))
+        self.assertEqual(results[0], results[1])
+
+
 def test_suite():
     return unittest.TestSuite([
         doctest.DocTestSuite(imgdiff),